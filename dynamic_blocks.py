@@ -10,15 +10,39 @@ It lets you:
 Supported family type in this MVP: Rectangle (planar polyline) with Width and Height.
 """
 
-import json
+import re
 import uuid
 
 import Rhino
 import rhinoscriptsyntax as rs
 import scriptcontext as sc
 
+# Prefer a C JSON codec when one is installed (Rhino 8 CPython); IronPython
+# falls through to the standard library.
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+    _loads = orjson.loads
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+    _dumps = json.dumps
+    _loads = json.loads
+
 STORE_SECTION = "RhinoDynamicBlocks"
 STORE_KEY = "Registry"
+CACHE_PREFIX = "dynblk"
+
+
+def _canon_values(values):
+    # Parameter values are stored as floats rounded to 6 places so they compare
+    # and hash consistently (registry, definition cache keys and names).
+    return dict((k, round(float(v), 6)) for k, v in values.items())
 
 
 class Family(object):
@@ -32,22 +56,116 @@ class Family(object):
 class DynamicBlockRegistry(object):
     def __init__(self, doc):
         self.doc = doc
+        # Serialized fragments reused by save(); None means "rebuild on next save".
+        self._families_json = None
+        self._instance_json = None
+        self._extra_json = None
+        # Lookup indexes; set by _load and shared through the sc.sticky cache.
+        self._name_index = None
+        self._by_family = None
         self.data = self._load()
+        self._idef_cache = {}
+        self._guid_cache = {}
+        self._batch_depth = 0
+        self._dirty = False
+
+    def __enter__(self):
+        self._batch_depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._batch_depth -= 1
+        if self._batch_depth == 0 and self._dirty:
+            self.save()
+        return False
+
+    # The cache holds the whole parsed registry (plus fragments and indexes) for
+    # each open document for the rest of the Rhino session; entries are replaced
+    # on save or reparse but not removed when the document closes.
+    @staticmethod
+    def _cache_key(doc):
+        return (CACHE_PREFIX, doc.RuntimeSerialNumber)
+
+    @classmethod
+    def invalidate(cls, doc):
+        sc.sticky.pop(cls._cache_key(doc), None)
 
     def _load(self):
         raw = self.doc.Strings.GetValue(STORE_SECTION, STORE_KEY)
         if not raw:
-            return {"families": {}, "instances": {}}
+            return self._build_indexes({"families": {}, "instances": {}})
+
+        # Reuse the parsed registry from a previous command as long as the
+        # stored string is unchanged (undo or other scripts may rewrite it).
+        cached = sc.sticky.get(self._cache_key(self.doc))
+        if cached is not None and cached[0] == raw:
+            (_, data, self._families_json, self._instance_json, self._extra_json,
+             self._name_index, self._by_family) = cached
+            return data
+
         try:
-            loaded = json.loads(raw)
+            loaded = _loads(raw)
             loaded.setdefault("families", {})
             loaded.setdefault("instances", {})
-            return loaded
         except Exception:
-            return {"families": {}, "instances": {}}
+            # Don't keep serving a registry the document no longer holds.
+            self.invalidate(self.doc)
+            return self._build_indexes({"families": {}, "instances": {}})
+        self._build_indexes(loaded)
+        self._remember(raw, loaded)
+        return loaded
+
+    def _build_indexes(self, data):
+        self._name_index = dict(
+            (family["name"].lower(), family_id)
+            for family_id, family in data["families"].items()
+        )
+        self._by_family = {}
+        for obj_id, info in data["instances"].items():
+            self._by_family.setdefault(info["family_id"], set()).add(obj_id)
+        return data
+
+    def _remember(self, raw, data):
+        sc.sticky[self._cache_key(self.doc)] = (
+            raw, data, self._families_json, self._instance_json, self._extra_json,
+            self._name_index, self._by_family,
+        )
+
+    @staticmethod
+    def _dump_instance(obj_id, info):
+        return _dumps(obj_id) + ": " + _dumps(info)
 
     def save(self):
-        self.doc.Strings.SetString(STORE_SECTION, STORE_KEY, json.dumps(self.data))
+        # Inside a `with registry:` block writes are deferred to the outermost exit.
+        if self._batch_depth > 0:
+            self._dirty = True
+            return
+        self._dirty = False
+
+        # Only families and changed instances are re-encoded; everything else
+        # is stitched together from the cached fragments.
+        if self._families_json is None:
+            self._families_json = _dumps(self.data["families"])
+        if self._instance_json is None:
+            self._instance_json = dict(
+                (obj_id, self._dump_instance(obj_id, info))
+                for obj_id, info in self.data["instances"].items()
+            )
+        if self._extra_json is None:
+            # Top-level keys this script does not manage are carried through as-is.
+            self._extra_json = "".join(
+                ", %s: %s" % (_dumps(key), _dumps(value))
+                for key, value in self.data.items()
+                if key not in ("families", "instances")
+            )
+        raw = '{"families": %s, "instances": {%s}%s}' % (
+            self._families_json,
+            ", ".join(self._instance_json.values()),
+            self._extra_json,
+        )
+
+        self.doc.Strings.SetString(STORE_SECTION, STORE_KEY, raw)
+        self._remember(raw, self.data)
 
     def add_family(self, family):
         self.data["families"][family.family_id] = {
@@ -55,87 +173,172 @@ class DynamicBlockRegistry(object):
             "family_type": family.family_type,
             "parameters": family.parameters,
         }
+        self._name_index[family.name.lower()] = family.family_id
+        self._families_json = None
+        self.save()
+
+    def set_family_parameters(self, family_id, parameters):
+        self.data["families"][family_id]["parameters"] = _canon_values(parameters)
+        self._families_json = None
         self.save()
 
     def get_family(self, family_id):
         return self.data["families"].get(family_id)
 
     def find_family_by_name(self, name):
-        for family_id, family in self.data["families"].items():
-            if family["name"].lower() == name.lower():
-                return family_id, family
-        return None, None
+        family_id = self._name_index.get(name.lower())
+        if family_id is None:
+            return None, None
+        return family_id, self.data["families"][family_id]
 
+    # Instance ids are passed in as strings; callers convert Rhino Guids once.
     def add_instance(self, obj_id, family_id, values):
-        self.data["instances"][str(obj_id)] = {"family_id": family_id, "values": values}
+        previous = self.data["instances"].get(obj_id)
+        if previous is not None:
+            self._by_family.get(previous["family_id"], set()).discard(obj_id)
+        info = {"family_id": family_id, "values": _canon_values(values)}
+        self.data["instances"][obj_id] = info
+        self._by_family.setdefault(family_id, set()).add(obj_id)
+        if self._instance_json is not None:
+            self._instance_json[obj_id] = self._dump_instance(obj_id, info)
+        self.save()
+
+    def set_instance_values(self, obj_id, values):
+        info = self.data["instances"][obj_id]
+        info["values"] = _canon_values(values)
+        if self._instance_json is not None:
+            self._instance_json[obj_id] = self._dump_instance(obj_id, info)
         self.save()
 
     def get_instance(self, obj_id):
-        return self.data["instances"].get(str(obj_id))
+        return self.data["instances"].get(obj_id)
 
     def remove_instance(self, obj_id):
-        self.data["instances"].pop(str(obj_id), None)
+        info = self.data["instances"].pop(obj_id, None)
+        if info is not None:
+            self._by_family.get(info["family_id"], set()).discard(obj_id)
+        if self._instance_json is not None:
+            self._instance_json.pop(obj_id, None)
         self.save()
 
+    def guid(self, obj_id):
+        guid = self._guid_cache.get(obj_id)
+        if guid is None:
+            guid = self._guid_cache[obj_id] = Rhino.Guid(obj_id)
+        return guid
+
     def iter_instances_for_family(self, family_id):
-        for obj_id, info in self.data["instances"].items():
-            if info["family_id"] == family_id:
-                yield obj_id, info
+        instances = self.data["instances"]
+        for obj_id in self._by_family.get(family_id, ()):
+            yield obj_id, instances[obj_id]
 
 
 # ---------- Geometry factories ----------
 
 def make_rectangle_geometry(width, height):
-    p0 = Rhino.Geometry.Point3d(0, 0, 0)
-    p1 = Rhino.Geometry.Point3d(width, 0, 0)
-    p2 = Rhino.Geometry.Point3d(width, height, 0)
-    p3 = Rhino.Geometry.Point3d(0, height, 0)
-    poly = Rhino.Geometry.Polyline([p0, p1, p2, p3, p0])
-    return [poly.ToNurbsCurve()]
+    rect = Rhino.Geometry.Rectangle3d(Rhino.Geometry.Plane.WorldXY, width, height)
+    return [rect.ToNurbsCurve()]
 
 
 def build_geometry(family_type, values):
     if family_type == "rectangle":
-        return make_rectangle_geometry(float(values["Width"]), float(values["Height"]))
+        values = _canon_values(values)
+        return make_rectangle_geometry(values["Width"], values["Height"])
     raise ValueError("Unsupported family type: {}".format(family_type))
 
 
 # ---------- Block definition helpers ----------
 
-def definition_name(family_name, values):
-    payload = "_".join("{}={}".format(k, values[k]) for k in sorted(values.keys()))
-    return "DB_{}_{}".format(family_name, payload)
+# Precomputed definition names per family type. Parameters are listed in sorted
+# order so the names match the generic fallback in definition_name.
+NAME_TEMPLATES = {
+    "rectangle": ("DB_{name}_Height={Height}_Width={Width}", frozenset(["Height", "Width"])),
+}
+
+# The key=value part of a definition name, matching any parameter set.
+VARIANT_PAYLOAD = re.compile(r"^[^_=]+=[^_=]*(?:_[^_=]+=[^_=]*)*$")
 
 
-def ensure_definition(doc, family, values):
-    name = definition_name(family["name"], values)
+def definition_name(family, values):
+    entry = NAME_TEMPLATES.get(family["family_type"])
+    # The template only names its own keys, so extra values must take the generic path.
+    if entry is not None and entry[1] == frozenset(values):
+        return entry[0].format(name=family["name"], **values)
+    payload = "_".join("{}={}".format(k, values[k]) for k in sorted(values.keys()))
+    return "DB_{}_{}".format(family["name"], payload)
+
+
+def ensure_definition(doc, family, values, registry=None):
+    key = None
+    if registry is not None:
+        key = (family["name"], tuple(sorted(values.items())))
+        idx = registry._idef_cache.get(key)
+        if idx is not None:
+            # The user may have purged the definition since it was cached.
+            idef = doc.InstanceDefinitions[idx]
+            if idef is not None and not idef.IsDeleted:
+                return idx
+            del registry._idef_cache[key]
+
+    name = definition_name(family, values)
     idef = doc.InstanceDefinitions.Find(name, True)
     if idef:
-        return idef.Index
-
-    geometry = build_geometry(family["family_type"], values)
-    base_point = Rhino.Geometry.Point3d(0, 0, 0)
-    attrs = [doc.CreateDefaultAttributes() for _ in geometry]
-    idx = doc.InstanceDefinitions.Add(name, "Dynamic block variant", base_point, geometry, attrs)
+        idx = idef.Index
+    else:
+        geometry = build_geometry(family["family_type"], values)
+        base_point = Rhino.Geometry.Point3d(0, 0, 0)
+        # InstanceDefinitions.Add only reads the attributes, so one copy can be shared.
+        attrs = [doc.CreateDefaultAttributes()] * len(geometry)
+        idx = doc.InstanceDefinitions.Add(name, "Dynamic block variant", base_point, geometry, attrs)
+
+    if key is not None and idx >= 0:
+        registry._idef_cache[key] = idx
     return idx
 
 
-def replace_instance_geometry(doc, instance_id, family, values):
-    obj_ref = doc.Objects.FindId(Rhino.Guid(instance_id))
-    if obj_ref is None:
-        return False
+def purge_unused_definitions(doc, family):
+    # Variant names are "DB_<family>_" followed by "_"-joined key=value pairs
+    # (see definition_name); the pair check keeps e.g. family "A" from
+    # matching variants of family "A_B".
+    prefix = "DB_{}_".format(family["name"])
+    purged = 0
+    for idef in list(doc.InstanceDefinitions):
+        if idef is None or idef.IsDeleted or not idef.Name.startswith(prefix):
+            continue
+        if not VARIANT_PAYLOAD.match(idef.Name[len(prefix):]):
+            continue
+        # 1 = top-level and nested references.
+        if idef.InUse(1):
+            continue
+        # deleteReferenceObjects=False: Rhino refuses if anything still references it.
+        if doc.InstanceDefinitions.Delete(idef.Index, False, True):
+            purged += 1
+    return purged
 
-    inst_obj = obj_ref
+
+def replace_instance_geometry(doc, instance_id, family, values, registry=None):
+    guid = registry.guid(instance_id) if registry is not None else Rhino.Guid(instance_id)
+    inst_obj = doc.Objects.FindId(guid)
     if not isinstance(inst_obj, Rhino.DocObjects.InstanceObject):
         return False
 
+    idef_index = ensure_definition(doc, family, values, registry)
+    if idef_index < 0:
+        return False
+
+    # Rhino 8 can swap the definition in place, which keeps the object id,
+    # attributes and any external references to it intact.
+    if hasattr(doc.Objects, "ReplaceInstanceObject"):
+        if doc.Objects.ReplaceInstanceObject(guid, idef_index):
+            return instance_id
+        return False
+
+    # Rhino 7: delete and re-add, which gives the instance a new id.
     xform = inst_obj.InstanceXform
     attr = inst_obj.Attributes.Duplicate()
-
     if not doc.Objects.Delete(inst_obj, False):
         return False
 
-    idef_index = ensure_definition(doc, family, values)
     new_id = doc.Objects.AddInstanceObject(idef_index, xform, attr)
     if new_id == Rhino.Guid.Empty:
         return False
@@ -168,7 +371,7 @@ def cmd_create_rectangle_family():
         family_id=str(uuid.uuid4()),
         name=name,
         family_type="rectangle",
-        parameters={"Width": default_w, "Height": default_h},
+        parameters=_canon_values({"Width": default_w, "Height": default_h}),
     )
     reg.add_family(family)
     rs.MessageBox("Created family '{}'".format(name), 0, "Dynamic Blocks")
@@ -181,19 +384,20 @@ def cmd_insert_instance():
         rs.MessageBox("No families found. Create one first.", 0, "Dynamic Blocks")
         return
 
-    names = sorted([f["name"] for f in families.values()])
-    name = rs.ListBox(names, "Pick family", "Dynamic Blocks")
+    pairs = sorted((f["name"], fid) for fid, f in families.items())
+    name = rs.ListBox([n for n, _ in pairs], "Pick family", "Dynamic Blocks")
     if not name:
         return
 
-    family_id, family = reg.find_family_by_name(name)
-    if not family:
+    family_id = dict(pairs).get(name)
+    if family_id is None:
         return
+    family = families[family_id]
 
-    width = rs.GetReal("Width", float(family["parameters"]["Width"]), 0.001)
+    width = rs.GetReal("Width", family["parameters"]["Width"], 0.001)
     if width is None:
         return
-    height = rs.GetReal("Height", float(family["parameters"]["Height"]), 0.001)
+    height = rs.GetReal("Height", family["parameters"]["Height"], 0.001)
     if height is None:
         return
 
@@ -201,9 +405,9 @@ def cmd_insert_instance():
     if not pt:
         return
 
-    values = {"Width": round(width, 6), "Height": round(height, 6)}
-    idef_index = ensure_definition(sc.doc, family, values)
-    xform = Rhino.Geometry.Transform.Translation(pt.X, pt.Y, pt.Z)
+    values = _canon_values({"Width": width, "Height": height})
+    idef_index = ensure_definition(sc.doc, family, values, reg)
+    xform = Rhino.Geometry.Transform.Translation(Rhino.Geometry.Vector3d(pt))
     obj_id = sc.doc.Objects.AddInstanceObject(idef_index, xform)
     if obj_id == Rhino.Guid.Empty:
         rs.MessageBox("Failed to create instance", 0, "Dynamic Blocks")
@@ -218,8 +422,9 @@ def cmd_edit_instance_parameters():
     obj_id = rs.GetObject("Pick dynamic block instance", rs.filter.instance)
     if not obj_id:
         return
+    obj_id = str(obj_id)
 
-    inst = reg.get_instance(str(obj_id))
+    inst = reg.get_instance(obj_id)
     if not inst:
         rs.MessageBox("Selected instance is not managed by Dynamic Blocks.", 0, "Dynamic Blocks")
         return
@@ -230,21 +435,25 @@ def cmd_edit_instance_parameters():
         return
 
     cur_vals = inst["values"]
-    width = rs.GetReal("Width", float(cur_vals["Width"]), 0.001)
+    width = rs.GetReal("Width", cur_vals["Width"], 0.001)
     if width is None:
         return
-    height = rs.GetReal("Height", float(cur_vals["Height"]), 0.001)
+    height = rs.GetReal("Height", cur_vals["Height"], 0.001)
     if height is None:
         return
 
-    new_values = {"Width": round(width, 6), "Height": round(height, 6)}
-    new_id = replace_instance_geometry(sc.doc, str(obj_id), family, new_values)
+    new_values = _canon_values({"Width": width, "Height": height})
+    new_id = replace_instance_geometry(sc.doc, obj_id, family, new_values, reg)
     if not new_id:
         rs.MessageBox("Failed to update instance", 0, "Dynamic Blocks")
         return
 
-    reg.remove_instance(str(obj_id))
-    reg.add_instance(new_id, inst["family_id"], new_values)
+    if new_id == obj_id:
+        reg.set_instance_values(obj_id, new_values)
+    else:
+        with reg:
+            reg.remove_instance(obj_id)
+            reg.add_instance(new_id, inst["family_id"], new_values)
     sc.doc.Views.Redraw()
 
 
@@ -255,41 +464,55 @@ def cmd_sync_family_instances():
         rs.MessageBox("No families available.", 0, "Dynamic Blocks")
         return
 
-    names = sorted([f["name"] for f in families.values()])
-    name = rs.ListBox(names, "Pick family to update all instances", "Dynamic Blocks")
+    pairs = sorted((f["name"], fid) for fid, f in families.items())
+    name = rs.ListBox([n for n, _ in pairs], "Pick family to update all instances", "Dynamic Blocks")
     if not name:
         return
 
-    family_id, family = reg.find_family_by_name(name)
-    if not family:
+    family_id = dict(pairs).get(name)
+    if family_id is None:
         return
+    family = families[family_id]
 
-    default_w = rs.GetReal("New default Width", float(family["parameters"]["Width"]), 0.001)
+    default_w = rs.GetReal("New default Width", family["parameters"]["Width"], 0.001)
     if default_w is None:
         return
-    default_h = rs.GetReal("New default Height", float(family["parameters"]["Height"]), 0.001)
+    default_h = rs.GetReal("New default Height", family["parameters"]["Height"], 0.001)
     if default_h is None:
         return
 
-    family["parameters"]["Width"] = round(default_w, 6)
-    family["parameters"]["Height"] = round(default_h, 6)
-
-    updates = []
-    for obj_id, info in list(reg.iter_instances_for_family(family_id)):
-        updates.append((obj_id, info))
-
-    for obj_id, info in updates:
-        # Keep per-instance values, unless you want global reset.
-        if not sc.doc.Objects.FindId(Rhino.Guid(obj_id)):
-            reg.remove_instance(obj_id)
-            continue
-
-        new_id = replace_instance_geometry(sc.doc, obj_id, family, info["values"])
-        if new_id and new_id != obj_id:
-            reg.remove_instance(obj_id)
-            reg.add_instance(new_id, family_id, info["values"])
-
-    reg.save()
+    # One redraw for the whole sync instead of one per instance.
+    redraw_enabled = sc.doc.Views.RedrawEnabled
+    sc.doc.Views.RedrawEnabled = False
+    try:
+        with reg:
+            reg.set_family_parameters(family_id, {"Width": default_w, "Height": default_h})
+
+            # Snapshot the items since the loop may add and remove registry entries.
+            for obj_id, info in list(reg.iter_instances_for_family(family_id)):
+                # Keep per-instance values, unless you want global reset.
+                inst_obj = sc.doc.Objects.FindId(reg.guid(obj_id))
+                if not inst_obj:
+                    reg.remove_instance(obj_id)
+                    continue
+
+                # Already pointing at the right variant: nothing to redraw.
+                target_idef = ensure_definition(sc.doc, family, info["values"], reg)
+                if (
+                    isinstance(inst_obj, Rhino.DocObjects.InstanceObject)
+                    and inst_obj.InstanceDefinition.Index == target_idef
+                ):
+                    continue
+
+                new_id = replace_instance_geometry(sc.doc, obj_id, family, info["values"], reg)
+                if new_id and new_id != obj_id:
+                    reg.remove_instance(obj_id)
+                    reg.add_instance(new_id, family_id, info["values"])
+
+        # Variants left behind by edits and syncs would otherwise pile up.
+        purge_unused_definitions(sc.doc, family)
+    finally:
+        sc.doc.Views.RedrawEnabled = redraw_enabled
     sc.doc.Views.Redraw()
     rs.MessageBox("Family '{}' synchronized.".format(name), 0, "Dynamic Blocks")
 